@@ -1,7 +1,19 @@
 import asyncio
+import functools
+import os
 import pathlib
 import hashlib
-from typing import List, Dict, Tuple
+import socket
+import sys
+import time
+from typing import BinaryIO, Iterable, List, Dict, Optional, Tuple
+
+try:  # optional: JIT-compiled RETR transform, see _to_wire()
+    import numpy as np
+    from numba import njit
+except ImportError:
+    np = None
+    njit = None
 
 # ===== Configuration =====
 MAILBOX_DIR = pathlib.Path("mailbox")  # Uses the same folder your SMTP server writes to
@@ -12,6 +24,17 @@ PASSWORD = "pass"
 # =========================
 
 CRLF = "\r\n"
+PROBE_CHUNK = 64 * 1024  # read size when checking whether a message can be sent verbatim
+WRITE_HIGH_WATER = 1024 * 1024  # transport buffer allowed before drain() pauses (RETR bodies)
+# Directory mtimes are coarse (ext4 ticks every few ms), so a scan whose stamp is this
+# recent may have missed a file added in the same tick and is not cached.
+MTIME_SLACK_NS = 2 * 10**9
+
+# Scan results shared by all sessions: root -> (dir mtime_ns, messages, sizes, uidls).
+# An entry is valid while the directory mtime is unchanged (files added/removed).
+# The SMTP side renames complete files into place, so contents never change under a name.
+_CACHE: Dict[pathlib.Path, Tuple[int, List[pathlib.Path], List[int], List[str]]] = {}
+
 
 class Maildrop:
     """
@@ -23,64 +46,93 @@ class Maildrop:
         self.messages: List[pathlib.Path] = []
         self.sizes: List[int] = []
         self.uidls: List[str] = []
-        self.deleted: Dict[int, bool] = {}  # 1-based index -> deleted?
+        self.deleted = bytearray()  # deleted[idx-1] is 1 once message idx is marked
+        self._count = 0   # undeleted messages, kept in step with dele()/rset()
+        self._octets = 0  # total size of undeleted messages
 
     def refresh(self):
-        self.messages = sorted([p for p in self.root.glob("*.eml") if p.is_file()])
-        self.sizes = [p.stat().st_size for p in self.messages]
-        self.uidls = [self._uidl_for(p) for p in self.messages]
-        self.deleted = {}
+        # Lists are shared with other sessions through _CACHE and must not be mutated;
+        # per-session state lives in self.deleted only.
+        stamp = os.stat(self.root).st_mtime_ns
+        scanned_at = time.time_ns()
+        cached = _CACHE.get(self.root)
+        if cached is not None and cached[0] == stamp:
+            _, self.messages, self.sizes, self.uidls = cached
+        else:
+            # One scandir pass; entry.stat() is cached, so each file costs one stat call
+            with os.scandir(self.root) as it:
+                entries = sorted(
+                    (e for e in it if e.name.endswith(".eml") and e.is_file()),
+                    key=lambda e: e.name,
+                )
+            stats = [e.stat() for e in entries]
+            self.messages = [pathlib.Path(e.path) for e in entries]
+            self.sizes = [st.st_size for st in stats]
+            self.uidls = [self._uidl_for(e.name, st) for e, st in zip(entries, stats)]
+            if scanned_at - stamp > MTIME_SLACK_NS:
+                _CACHE[self.root] = (stamp, self.messages, self.sizes, self.uidls)
+            else:
+                _CACHE.pop(self.root, None)
+        self.rset()
 
     def count_and_octets(self) -> Tuple[int, int]:
-        count = sum(0 if self.deleted.get(i+1) else 1 for i in range(len(self.messages)))
-        octets = sum(self.sizes[i] for i in range(len(self.messages)) if not self.deleted.get(i+1))
-        return count, octets
+        return self._count, self._octets
 
     def list_all(self) -> List[Tuple[int, int]]:
-        return [(i+1, self.sizes[i]) for i in range(len(self.messages)) if not self.deleted.get(i+1)]
+        return [(i, size) for i, (size, d) in enumerate(zip(self.sizes, self.deleted), start=1) if not d]
 
     def list_one(self, idx: int) -> Tuple[int, int]:
         self._ensure_index(idx)
-        if self.deleted.get(idx):
+        if self.deleted[idx-1]:
             raise IndexError("Message already deleted")
         return idx, self.sizes[idx-1]
 
     def retr(self, idx: int) -> bytes:
         self._ensure_index(idx)
-        if self.deleted.get(idx):
+        if self.deleted[idx-1]:
             raise IndexError("Message already deleted")
         with self.messages[idx-1].open("rb") as f:
             data = f.read()
-        # Normalize to CRLF lines and dot-stuff as per POP3 transmission rules
-        text = data.decode("utf-8", errors="replace")
-        lines = text.replace("\r\n", "\n").replace("\r", "\n").split("\n")
-        out_lines = []
-        for line in lines:
-            if line.startswith("."):
-                out_lines.append("." + line)  # dot-stuffing
-            else:
-                out_lines.append(line)
-        payload = (CRLF.join(out_lines) + CRLF + "." + CRLF).encode("utf-8", errors="replace")
-        return payload
+        return _to_wire(data)
+
+    def open_wire(self, idx: int) -> Optional[BinaryIO]:
+        """
+        Open a message for verbatim transmission (sendfile) when it is already in
+        wire form: CRLF-only, CRLF-terminated and without lines starting with '.'.
+        Returns None if the message needs the retr() transform instead.
+        """
+        self._ensure_index(idx)
+        if self.deleted[idx-1]:
+            raise IndexError("Message already deleted")
+        path = self.messages[idx-1]
+        st = path.stat()
+        if not st.st_size or not _wire_clean_cached(str(path), st.st_size, st.st_mtime_ns):
+            return None
+        return path.open("rb")
 
     def dele(self, idx: int):
         self._ensure_index(idx)
-        if self.deleted.get(idx):
+        if self.deleted[idx-1]:
             raise IndexError("Message already deleted")
-        self.deleted[idx] = True
+        self.deleted[idx-1] = 1
+        self._count -= 1
+        self._octets -= self.sizes[idx-1]
 
     def rset(self):
-        self.deleted = {}
+        self.deleted = bytearray(len(self.messages))
+        self._count = len(self.messages)
+        self._octets = sum(self.sizes)
 
     def commit(self):
         # Physically remove deleted files
-        for i, p in enumerate(self.messages, start=1):
-            if self.deleted.get(i):
+        for p, d in zip(self.messages, self.deleted):
+            if d:
                 try:
                     p.unlink(missing_ok=True)
                 except Exception:
                     pass
         # Reload state after deletion to keep things consistent
+        _CACHE.pop(self.root, None)
         self.refresh()
 
     def _ensure_index(self, idx: int):
@@ -88,16 +140,113 @@ class Maildrop:
             raise IndexError("No such message")
 
     @staticmethod
-    def _uidl_for(path: pathlib.Path) -> str:
-        # Simple UIDL from filename + size hash
-        h = hashlib.sha1()
-        h.update(path.name.encode("utf-8"))
-        try:
-            h.update(str(path.stat().st_size).encode("ascii"))
-            h.update(str(int(path.stat().st_mtime)).encode("ascii"))
-        except Exception:
-            pass
-        return h.hexdigest()
+    def _uidl_for(name: str, st: os.stat_result) -> str:
+        return _uidl_cached(name, st.st_size, int(st.st_mtime))
+
+
+def _to_wire_py(data: bytes) -> bytes:
+    # Normalize to CRLF lines and dot-stuff as per POP3 transmission rules
+    data = data.replace(b"\r\n", b"\n").replace(b"\r", b"\n").replace(b"\n", b"\r\n")
+    data = data.replace(b"\r\n.", b"\r\n..")
+    if data.startswith(b"."):
+        data = b"." + data  # dot-stuffing
+    if not data.endswith(b"\r\n"):
+        data += b"\r\n"
+    return data + b".\r\n"
+
+
+if njit is not None:
+    @njit(cache=True)
+    def _wire_kernel(src, out):
+        # Single pass over the message: CR, LF and CRLF all become CRLF, a '.' at the
+        # start of a line is doubled, and the ".\r\n" terminator is appended.
+        n = src.shape[0]
+        i = 0
+        j = 0
+        bol = True
+        while i < n:
+            c = src[i]
+            if c == 13 or c == 10:
+                if c == 13 and i + 1 < n and src[i + 1] == 10:
+                    i += 1
+                out[j] = 13
+                out[j + 1] = 10
+                j += 2
+                bol = True
+            else:
+                if bol and c == 46:
+                    out[j] = 46
+                    j += 1
+                out[j] = c
+                j += 1
+                bol = False
+            i += 1
+        if j == 0 or not bol:
+            out[j] = 13
+            out[j + 1] = 10
+            j += 2
+        out[j] = 46
+        out[j + 1] = 13
+        out[j + 2] = 10
+        return j + 3
+
+    def _to_wire(data: bytes) -> bytes:
+        src = np.frombuffer(data, dtype=np.uint8)
+        out = np.empty(2 * len(src) + 5, dtype=np.uint8)  # worst case: every byte doubles
+        n = _wire_kernel(src, out)
+        return out[:n].tobytes()
+else:
+    _to_wire = _to_wire_py
+
+
+@functools.lru_cache(maxsize=65536)
+def _uidl_cached(name: str, size: int, mtime: int) -> str:
+    # Simple UIDL from filename + size + mtime hash; deterministic, so memoized across scans
+    return hashlib.blake2b(f"{name}\x00{size}\x00{mtime}".encode("utf-8"), digest_size=16).hexdigest()
+
+
+@functools.lru_cache(maxsize=65536)
+def _wire_clean_cached(path: str, size: int, mtime_ns: int) -> bool:
+    # Probe result per file version; saved messages are never rewritten in place,
+    # so each message is scanned once rather than on every RETR
+    with open(path, "rb") as f:
+        return _is_wire_clean(f)
+
+
+def _is_wire_clean(f: BinaryIO) -> bool:
+    # Scan in bounded chunks, carrying the last byte over so that CRLF pairs and
+    # "\n." sequences split across chunk boundaries are still seen.
+    tail = b"\n"  # start of file counts as start of a line
+    while True:
+        chunk = f.read(PROBE_CHUNK)
+        if not chunk:
+            return tail == b"\n"
+        window = tail + chunk
+        pairs = window.count(b"\r\n")
+        if (b"\n." in window
+                or chunk.count(b"\n") != pairs
+                or window.count(b"\r", 0, len(window) - 1) != pairs):
+            return False
+        tail = chunk[-1:]
+
+
+def _verb_token(line: bytes) -> int:
+    # All POP3 verbs are 4 bytes: pack them into a case-folded int (OR 0x20 per byte)
+    # so the state tables are int-keyed. Returns 0 for verbs longer than 4 bytes.
+    if len(line) > 4 and line[4] not in b" \r\n":
+        return 0
+    return int.from_bytes(line[:4].ljust(4, b" "), "little") | 0x20202020
+
+
+TOK_USER = _verb_token(b"USER")
+TOK_PASS = _verb_token(b"PASS")
+TOK_QUIT = _verb_token(b"QUIT")
+TOK_STAT = _verb_token(b"STAT")
+TOK_LIST = _verb_token(b"LIST")
+TOK_RETR = _verb_token(b"RETR")
+TOK_DELE = _verb_token(b"DELE")
+TOK_NOOP = _verb_token(b"NOOP")
+TOK_RSET = _verb_token(b"RSET")
 
 
 class POP3Session:
@@ -110,51 +259,39 @@ class POP3Session:
         self.state = "AUTH"  # AUTH or TRANSACTION
         self.user = None
         self.maildrop = Maildrop(MAILBOX_DIR)
+        self.closing = False
+        # Per-state command tables: one dict lookup per command
+        self._commands = {
+            "AUTH": {
+                TOK_USER: self._cmd_user,
+                TOK_PASS: self._cmd_pass,
+                TOK_QUIT: self._cmd_quit,
+            },
+            "TRANSACTION": {
+                TOK_STAT: self._cmd_stat,
+                TOK_LIST: self._cmd_list,
+                TOK_RETR: self._cmd_retr,
+                TOK_DELE: self._cmd_dele,
+                TOK_NOOP: self._cmd_noop,
+                TOK_RSET: self._cmd_rset,
+                TOK_QUIT: self._cmd_quit,
+            },
+        }
 
     async def run(self):
         await self._send_ok("POP3 server ready")
-        while True:
+        while not self.closing:
             line = await self.r.readline()
             if not line:
                 break
-            raw = line.decode("utf-8", errors="replace").rstrip("\r\n")
-            cmd, *args = raw.split()
-            cmd_u = cmd.upper()
-
             try:
-                if self.state == "AUTH":
-                    if cmd_u == "USER":
-                        await self._cmd_user(args)
-                    elif cmd_u == "PASS":
-                        await self._cmd_pass(args)
-                    elif cmd_u == "QUIT":
-                        await self._send_ok("Bye")
-                        break
-                    else:
-                        await self._send_err("Authenticate first (USER/PASS)")
-                elif self.state == "TRANSACTION":
-                    if cmd_u == "STAT":
-                        await self._cmd_stat()
-                    elif cmd_u == "LIST":
-                        await self._cmd_list(args)
-                    elif cmd_u == "RETR":
-                        await self._cmd_retr(args)
-                    elif cmd_u == "DELE":
-                        await self._cmd_dele(args)
-                    elif cmd_u == "NOOP":
-                        await self._send_ok()
-                    elif cmd_u == "RSET":
-                        self.maildrop.rset()
-                        await self._send_ok("Reset")
-                    elif cmd_u == "QUIT":
-                        # Enter UPDATE state: commit deletions, then close
-                        self.maildrop.commit()
-                        await self._send_ok("Bye")
-                        break
-                    else:
-                        await self._send_err("Unknown or unsupported command")
+                handler = self._commands[self.state].get(_verb_token(line))
+                if handler is not None:
+                    await handler(line[4:].decode("utf-8", errors="replace").split())
+                elif self.state == "AUTH":
+                    await self._send_err("Authenticate first (USER/PASS)")
                 else:
-                    await self._send_err("Bad state")
+                    await self._send_err("Unknown or unsupported command")
             except Exception as e:
                 await self._send_err(str(e))
 
@@ -164,6 +301,13 @@ class POP3Session:
         except Exception:
             pass
 
+    async def _cmd_quit(self, args: List[str]):
+        if self.state == "TRANSACTION":
+            # Enter UPDATE state: commit deletions, then close
+            self.maildrop.commit()
+        self.closing = True
+        await self._send_ok("Bye")
+
     # ===== AUTH commands =====
     async def _cmd_user(self, args: List[str]):
         if len(args) != 1:
@@ -191,17 +335,15 @@ class POP3Session:
             await self._send_err("Authentication failed")
 
     # ===== TRANSACTION commands =====
-    async def _cmd_stat(self):
+    async def _cmd_stat(self, args: List[str]):
         count, octets = self.maildrop.count_and_octets()
         await self._send_ok(f"{count} {octets}")
 
     async def _cmd_list(self, args: List[str]):
         if len(args) == 0:
             all_msgs = self.maildrop.list_all()
-            await self._send_ok(f"{len(all_msgs)} messages")
-            for i, size in all_msgs:
-                await self._write_line(f"{i} {size}")
-            await self._write_line(".")
+            await self._write_multiline(f"+OK {len(all_msgs)} messages",
+                                        (f"{i} {size}" for i, size in all_msgs))
         elif len(args) == 1:
             try:
                 idx = int(args[0])
@@ -222,12 +364,34 @@ class POP3Session:
         except ValueError:
             await self._send_err("Syntax: RETR <msg>")
             return
-        payload = self.maildrop.retr(idx)
-        # +OK <octets> (octets = size of message on disk; fine to reuse)
-        _, size = self.maildrop.list_one(idx)
-        await self._send_ok(f"{size} octets")
-        self.w.write(payload)
-        await self.w.drain()
+        # Reading and probing the file is blocking disk I/O; keep it off the event loop
+        loop = asyncio.get_running_loop()
+        f = await loop.run_in_executor(None, self.maildrop.open_wire, idx)
+        try:
+            payload = await loop.run_in_executor(None, self.maildrop.retr, idx) if f is None else None
+            # +OK <octets> (octets = size of message on disk; fine to reuse)
+            _, size = self.maildrop.list_one(idx)
+            await self._send_ok(f"{size} octets")
+            if f is not None:
+                # Already in wire form: let the kernel copy the file to the socket
+                try:
+                    await loop.sendfile(self.w.transport, f)
+                except NotImplementedError:
+                    # Loop without sendfile support (e.g. uvloop): plain write
+                    self.w.write(await loop.run_in_executor(None, f.read))
+                payload = b"." + CRLF.encode("ascii")
+            self.w.write(payload)
+            await self.w.drain()
+        finally:
+            if f is not None:
+                f.close()
+
+    async def _cmd_noop(self, args: List[str]):
+        await self._send_ok()
+
+    async def _cmd_rset(self, args: List[str]):
+        self.maildrop.rset()
+        await self._send_ok("Reset")
 
     async def _cmd_dele(self, args: List[str]):
         if len(args) != 1:
@@ -248,13 +412,31 @@ class POP3Session:
     async def _send_err(self, msg: str = "Error"):
         await self._write_line(f"-ERR {msg}")
 
+    async def _write_multiline(self, first: str, lines: Iterable[str]):
+        # Build the whole multi-line response (status line, body, ".") and drain once
+        buf = bytearray((first + CRLF).encode("utf-8", errors="replace"))
+        for line in lines:
+            buf += (line + CRLF).encode("utf-8", errors="replace")
+        buf += b"." + CRLF.encode("ascii")
+        self.w.write(buf)
+        await self.w.drain()
+
     async def _write_line(self, s: str):
         data = (s + CRLF).encode("utf-8", errors="replace")
         self.w.write(data)
         await self.w.drain()
 
 
+def _tune_transport(writer: asyncio.StreamWriter):
+    sock = writer.get_extra_info("socket")
+    if sock is not None and sock.family in (socket.AF_INET, socket.AF_INET6):
+        # Replies are small and sent one per command; don't hold them back for Nagle
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    writer.transport.set_write_buffer_limits(high=WRITE_HIGH_WATER)
+
+
 async def handle_client(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+    _tune_transport(writer)
     session = POP3Session(reader, writer)
     await session.run()
 
@@ -268,7 +450,17 @@ async def main(host=POP3_HOST, port=POP3_PORT):
 
 
 if __name__ == "__main__":
+    run_kwargs = {}
+    try:
+        import uvloop  # optional, faster event loop
+    except ImportError:
+        pass
+    else:
+        if sys.version_info >= (3, 12):
+            run_kwargs["loop_factory"] = uvloop.new_event_loop
+        else:  # loop policies are deprecated from 3.14 on
+            asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
     try:
-        asyncio.run(main())
+        asyncio.run(main(), **run_kwargs)
     except KeyboardInterrupt:
         print("\n👋 POP3 server stopped")
@@ -1,117 +1,236 @@
 # smtp_server_complete.py
 import asyncio
+import itertools
+import logging
 import socket
+import sys
 import re
 import os
-import uuid
-import datetime
+import threading
+import time
 
 MAILBOX_DIR = "mailbox"
+logger = logging.getLogger("smtp")  # protocol trace at DEBUG; enable with SMTP_DEBUG=1
+HOSTNAME = socket.gethostname()  # looked up once, not per connection
+MAX_MESSAGE_SIZE = 16 * 1024 * 1024  # DATA bodies larger than this get 552
+WRITE_HIGH_WATER = 1024 * 1024  # transport buffer allowed before drain() pauses
+DRAIN_THRESHOLD = 32 * 1024  # only await drain() once this much output is queued
+
+MAIL_FROM_RE = re.compile(rb"MAIL FROM:\s*<([^>]+)>", re.IGNORECASE)
+RCPT_TO_RE = re.compile(rb"RCPT TO:\s*<([^>]+)>", re.IGNORECASE)
+
+# Fixed replies, pre-encoded
+R_GREETING = f"220 {HOSTNAME} SMTP Server ready\r\n".encode("ascii")
+R_GREETS = f"250 {HOSTNAME} greets ".encode("ascii")
+R_OK = b"250 OK\r\n"
+R_ACCEPTED = b"250 OK: Message accepted for delivery\r\n"
+R_START_DATA = b"354 End data with <CRLF>.<CRLF>\r\n"
+R_BYE = b"221 Bye\r\n"
+R_LINE_TOO_LONG = b"500 Syntax error, command line too long\r\n"
+R_SYNTAX = b"501 Syntax error in parameters or arguments\r\n"
+R_NOT_IMPLEMENTED = b"502 Command not implemented\r\n"
+R_BAD_SEQ = b"503 Bad sequence of commands\r\n"
+R_TOO_BIG = b"552 Message size exceeds fixed maximum message size\r\n"
+
+def _verb_token(line: bytes) -> int:
+    # Pack the 4-byte command verb into an int, OR-ing in 0x20 per byte to fold ASCII
+    # case, so tables are int-keyed and no upper() is needed. Returns 0 (no command)
+    # if the verb is longer than 4 bytes.
+    if len(line) > 4 and line[4] not in b" \r\n":
+        return 0
+    return int.from_bytes(line[:4].ljust(4, b" "), "little") | 0x20202020
+
+
+TOK_HELO = _verb_token(b"HELO")
+TOK_MAIL = _verb_token(b"MAIL")
+TOK_RCPT = _verb_token(b"RCPT")
+TOK_DATA = _verb_token(b"DATA")
+TOK_QUIT = _verb_token(b"QUIT")
+
+
+# Filename entropy is drawn from a batched os.urandom pool. save_email runs in
+# executor threads, so the pool and counter are guarded by a lock.
+_RAND_POOL = b""
+_RAND_OFF = 0
+_SEQ = itertools.count()
+_NAME_LOCK = threading.Lock()
+
+
+def _unique_filename():
+    # <UTC YYYYMMDDHHMMSS>_<ns>_<seq>_<random>.eml: same second-resolution prefix as the
+    # older <YYYYMMDDHHMMSS>_<uuid4>.eml names, so old and new files sort together in
+    # arrival order; the zero-padded nanoseconds order messages within a second
+    global _RAND_POOL, _RAND_OFF
+    with _NAME_LOCK:
+        if _RAND_OFF + 8 > len(_RAND_POOL):
+            _RAND_POOL = os.urandom(8192)
+            _RAND_OFF = 0
+        token = _RAND_POOL[_RAND_OFF:_RAND_OFF + 8]
+        _RAND_OFF += 8
+        seq = next(_SEQ)
+    sec, ns = divmod(time.time_ns(), 10**9)
+    return f"{time.strftime('%Y%m%d%H%M%S', time.gmtime(sec))}_{ns:09d}_{seq:x}_{token.hex()}.eml"
+
 
 # Save email to local mailbox directory as .eml file
 def save_email(mail_from, rcpt_to, body):
     os.makedirs(MAILBOX_DIR, exist_ok=True)
-    filename = datetime.datetime.utcnow().strftime("%Y%m%d%H%M%S") + "_" + str(uuid.uuid4()) + ".eml"
-    filepath = os.path.join(MAILBOX_DIR, filename)
+    filepath = os.path.join(MAILBOX_DIR, _unique_filename())
 
-    with open(filepath, "w") as f:
-        f.write(f"From: {mail_from}\n")
+    # Stored with CRLF line endings so POP3 RETR can send the file as-is. Written under
+    # a .tmp name and renamed into place, so POP3 never sees (or caches) a partial .eml.
+    tmppath = filepath[:-len(".eml")] + ".tmp"
+    with open(tmppath, "wb") as f:
+        f.write(b"From: " + mail_from + b"\r\n")
         for rcpt in rcpt_to:
-            f.write(f"To: {rcpt}\n")
-        f.write("\n")
+            f.write(b"To: " + rcpt + b"\r\n")
+        f.write(b"\r\n")
         f.write(body)
+    os.replace(tmppath, filepath)
 
     print(f"📩 Saved email to {filepath}")
 
 
-async def handle_client(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
-    hostname = socket.gethostname()
-    state = {"helo": None, "mail_from": None, "rcpt_to": [], "data": None}
-
-    def send(line: str):
-        print(">>", line.strip())
-        writer.write((line + "\r\n").encode("ascii"))
+class SMTPSession:
+    """
+    A minimal SMTP session (HELO -> MAIL FROM -> RCPT TO -> DATA).
+    """
+    def __init__(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self.r = reader
+        self.w = writer
+        self.helo = None
+        self.mail_from = None
+        self.rcpt_to = []
+        self.data = None
+        self.closing = False
+        # Command table keyed by verb token: one dict lookup per command
+        self._commands = {
+            TOK_HELO: self._cmd_helo,
+            TOK_MAIL: self._cmd_mail,
+            TOK_RCPT: self._cmd_rcpt,
+            TOK_DATA: self._cmd_data,
+            TOK_QUIT: self._cmd_quit,
+        }
 
-    send(f"220 {hostname} SMTP Server ready")
-    await writer.drain()
+    def send(self, line: bytes):
+        logger.debug(">> %r", line)
+        self.w.write(line)
 
-    while True:
-        data = await reader.readline()
-        if not data:
-            break
-        message = data.decode("ascii").rstrip("\r\n")
-        print("<<", message)
+    async def flush(self):
+        # Replies are written straight to the socket when its buffer is empty, so
+        # only yield to drain() when output is actually backing up
+        if self.w.transport.get_write_buffer_size() > DRAIN_THRESHOLD:
+            await self.w.drain()
 
-        cmd_upper = message.upper()
+    async def run(self):
+        self.send(R_GREETING)
+        await self.flush()
 
-        if cmd_upper.startswith("HELO"):
-            parts = message.split(maxsplit=1)
-            state["helo"] = parts[1] if len(parts) > 1 else None
-            send(f"250 {hostname} greets {state['helo']}")
+        while not self.closing:
+            try:
+                data = await self.r.readline()
+            except ValueError:  # longer than the reader's limit (64 KiB by default)
+                self.send(R_LINE_TOO_LONG)
+                break
+            if not data:
+                break
+            logger.debug("<< %r", data)
 
-        elif cmd_upper.startswith("MAIL FROM:"):
-            if not state["helo"]:
-                send("503 Bad sequence of commands")
+            handler = self._commands.get(_verb_token(data))
+            if handler is not None:
+                await handler(data)
             else:
-                match = re.match(r"MAIL FROM:\s*<([^>]+)>", message, re.IGNORECASE)
-                if match:
-                    state["mail_from"] = match.group(1)
-                    state["rcpt_to"] = []
-                    state["data"] = None
-                    send("250 OK")
-                else:
-                    send("501 Syntax error in parameters or arguments")
-
-        elif cmd_upper.startswith("RCPT TO:"):
-            if not state["mail_from"]:
-                send("503 Bad sequence of commands")
-            else:
-                match = re.match(r"RCPT TO:\s*<([^>]+)>", message, re.IGNORECASE)
-                if match:
-                    state["rcpt_to"].append(match.group(1))
-                    send("250 OK")
-                else:
-                    send("501 Syntax error in parameters or arguments")
-
-        elif cmd_upper == "DATA":
-            if not state["rcpt_to"]:
-                send("503 Bad sequence of commands")
-            else:
-                send("354 End data with <CRLF>.<CRLF>")
-                await writer.drain()
+                self.send(R_NOT_IMPLEMENTED)
+
+            await self.flush()
 
-                lines = []
-                while True:
-                    line = await reader.readline()
-                    if not line:
-                        break
-                    line = line.decode("ascii").rstrip("\r\n")
+        self.w.close()
+        await self.w.wait_closed()
 
-                    if line == ".":
-                        break
-                    if line.startswith(".."):  # transparency rule
-                        line = line[1:]
+    async def _cmd_helo(self, line: bytes):
+        parts = line.rstrip(b"\r\n").split(maxsplit=1)
+        self.helo = parts[1] if len(parts) > 1 else None
+        self.send(R_GREETS + (self.helo or b"None") + b"\r\n")
 
-                    lines.append(line)
+    async def _cmd_mail(self, line: bytes):
+        if not self.helo:
+            self.send(R_BAD_SEQ)
+            return
+        match = MAIL_FROM_RE.match(line)
+        if match:
+            self.mail_from = match.group(1)
+            self.rcpt_to = []
+            self.data = None
+            self.send(R_OK)
+        else:
+            self.send(R_SYNTAX)
 
-                state["data"] = "\n".join(lines)
+    async def _cmd_rcpt(self, line: bytes):
+        if not self.mail_from:
+            self.send(R_BAD_SEQ)
+            return
+        match = RCPT_TO_RE.match(line)
+        if match:
+            self.rcpt_to.append(match.group(1))
+            self.send(R_OK)
+        else:
+            self.send(R_SYNTAX)
 
-                # Save email to mailbox
-                save_email(state["mail_from"], state["rcpt_to"], state["data"])
+    async def _cmd_data(self, line: bytes):
+        if not self.rcpt_to:
+            self.send(R_BAD_SEQ)
+            return
+        self.send(R_START_DATA)
+        await self.flush()
 
-                send("250 OK: Message accepted for delivery")
+        # Read the body in bulk. readuntil(".\r\n") also stops at ordinary lines
+        # ending in ".", so keep going until the buffer ends in <CRLF>.<CRLF>
+        # The reader keeps the default (command line) limit; a terminator further away
+        # than that raises LimitOverrunError with the data still buffered, so take the
+        # safe prefix and carry on, capping the body at MAX_MESSAGE_SIZE ourselves.
+        raw = bytearray()
+        try:
+            while not (raw == b".\r\n" or raw.endswith(b"\r\n.\r\n")):
+                try:
+                    raw += await self.r.readuntil(b".\r\n")
+                except asyncio.LimitOverrunError as e:
+                    raw += await self.r.readexactly(e.consumed)
+                if len(raw) > MAX_MESSAGE_SIZE:
+                    self.send(R_TOO_BIG)
+                    self.closing = True
+                    return
+        except asyncio.IncompleteReadError:
+            self.closing = True  # client went away mid-DATA; nothing is delivered
+            return
 
-        elif cmd_upper == "QUIT":
-            send("221 Bye")
-            break
+        body = bytes(raw[:-3])
+        if body.startswith(b".."):  # transparency rule
+            body = body[1:]
+        self.data = body.replace(b"\r\n..", b"\r\n.")
 
-        else:
-            send("502 Command not implemented")
+        # Save email to mailbox (in a worker thread so other sessions keep running)
+        await asyncio.get_running_loop().run_in_executor(
+            None, save_email, self.mail_from, self.rcpt_to, self.data)
 
-        await writer.drain()
+        self.send(R_ACCEPTED)
 
-    writer.close()
-    await writer.wait_closed()
+    async def _cmd_quit(self, line: bytes):
+        self.send(R_BYE)
+        self.closing = True
+
+
+def _tune_transport(writer: asyncio.StreamWriter):
+    sock = writer.get_extra_info("socket")
+    if sock is not None and sock.family in (socket.AF_INET, socket.AF_INET6):
+        # Every reply is a short line the client waits on; send it without Nagle delay
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    writer.transport.set_write_buffer_limits(high=WRITE_HIGH_WATER)
+
+
+async def handle_client(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+    _tune_transport(writer)
+    session = SMTPSession(reader, writer)
+    await session.run()
 
 
 async def main(host="0.0.0.0", port=2525):
@@ -122,7 +241,20 @@ async def main(host="0.0.0.0", port=2525):
 
 
 if __name__ == "__main__":
+    logging.basicConfig(format="%(message)s")
+    if os.environ.get("SMTP_DEBUG"):
+        logger.setLevel(logging.DEBUG)
+    run_kwargs = {}
+    try:
+        import uvloop  # optional, faster event loop
+    except ImportError:
+        pass
+    else:
+        if sys.version_info >= (3, 12):
+            run_kwargs["loop_factory"] = uvloop.new_event_loop
+        else:  # loop policies are deprecated from 3.14 on
+            asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
     try:
-        asyncio.run(main())
+        asyncio.run(main(), **run_kwargs)
     except KeyboardInterrupt:
         print("\n👋 Server stopped by user")
@@ -0,0 +1,66 @@
+import os
+import pathlib
+import tempfile
+import time
+import unittest
+
+import pop3_server
+import smtp_server
+
+
+class MaildropCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.root = pathlib.Path(self.tmp.name)
+        self.old_mailbox = smtp_server.MAILBOX_DIR
+        smtp_server.MAILBOX_DIR = self.tmp.name
+        pop3_server._CACHE.clear()
+
+    def tearDown(self):
+        smtp_server.MAILBOX_DIR = self.old_mailbox
+        pop3_server._CACHE.clear()
+        self.tmp.cleanup()
+
+    def _age_dir(self, ns_ago=3600 * 10**9):
+        # Pretend the directory was last changed long ago, so its scan gets cached
+        stamp = time.time_ns() - ns_ago
+        os.utime(self.root, ns=(stamp, stamp))
+        return stamp
+
+    def _scan(self):
+        m = pop3_server.Maildrop(self.root)
+        m.refresh()
+        return m
+
+    def test_partial_message_is_never_listed(self):
+        # save_email writes under .tmp and renames; a login mid-write must not see it
+        partial = self.root / "20260101000000_0_00.tmp"
+        partial.write_bytes(b"From: a@x\r\n")
+        self._age_dir()
+        self.assertEqual(self._scan().sizes, [])
+
+        smtp_server.save_email(b"a@x", [b"b@x"], b"x" * 700 + b"\r\n")
+        m = self._scan()
+        self.assertEqual(len(m.messages), 1)
+        self.assertEqual(m.sizes, [m.messages[0].stat().st_size])
+        self.assertGreater(m.sizes[0], 700)
+        self.assertEqual(sorted(p.suffix for p in self.root.iterdir()), [".eml", ".tmp"])
+
+    def test_cached_after_dir_settles(self):
+        (self.root / "a.eml").write_bytes(b"a\r\n")
+        stamp = self._age_dir()
+        self._scan()
+        self.assertEqual(pop3_server._CACHE[self.root][0], stamp)
+
+    def test_recent_stamp_is_rescanned(self):
+        # A file added within the same mtime tick as a scan must still show up
+        (self.root / "a.eml").write_bytes(b"a\r\n")
+        stamp = self._age_dir(ns_ago=0)
+        self.assertEqual(len(self._scan().messages), 1)
+        (self.root / "b.eml").write_bytes(b"b\r\n")
+        os.utime(self.root, ns=(stamp, stamp))
+        self.assertEqual(len(self._scan().messages), 2)
+
+
+if __name__ == "__main__":
+    unittest.main()